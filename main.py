@@ -1,12 +1,14 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 import pandas as pd
 import numpy as np
 import ccxt.async_support as ccxt
 import asyncio
+import time
+from numba import njit
 import plotly.graph_objs as go
-from plotly.subplots import make_subplots
+import plotly.io as pio
 from datetime import timedelta
 
 from starlette.responses import JSONResponse
@@ -16,173 +18,356 @@ app = FastAPI()
 # Указываем путь к шаблонам
 templates = Jinja2Templates(directory="templates")
 
-async def fetch_data(exchange, symbol, timeframe='1s', limit=168*60*60):  # 168 часов = 7 дней
-    """Асинхронное получение данных OHLCV для символа"""
+# Один экземпляр биржи на всё приложение: постоянная aiohttp-сессия
+# с keep-alive к api.binance.com, ccxt кэширует рынки на инстанс
+exchange = ccxt.binance({'enableRateLimit': True})
+
+MARKETS_TTL = 3600  # как часто перезагружать список рынков, секунды
+_markets_lock = asyncio.Lock()
+_markets_ts = 0.0
+_ticker_symbols = []
+
+# Кэш OHLCV: (symbol, timeframe) -> (время получения, DataFrame)
+_ohlcv_cache = {}
+
+# Ограничиваем число одновременных запросов к бирже (лимиты Binance)
+_fetch_semaphore = asyncio.Semaphore(20)
+
+async def load_markets_cached():
+    """Загрузка списка рынков не чаще одного раза в MARKETS_TTL секунд"""
+    global _markets_ts, _ticker_symbols
+    async with _markets_lock:
+        if not exchange.markets or time.time() - _markets_ts > MARKETS_TTL:
+            await exchange.load_markets(reload=True)
+            # Отфильтрованный список пар обновляем вместе с рынками,
+            # а не пересчитываем на каждый запрос
+            _ticker_symbols = [s for s in exchange.markets.keys() if s.endswith('/USDT') and s != 'BTC/USDT']
+            _markets_ts = time.time()
+    return exchange.markets
+
+async def get_ticker_symbols():
+    """Список пар */USDT без BTC/USDT, кэшируется вместе со списком рынков"""
+    await load_markets_cached()
+    return _ticker_symbols
+
+async def fetch_data(exchange, symbol, timeframe='1m', limit=7*24*60):  # 7 дней минутных свечей
+    """Асинхронное получение данных OHLCV для символа (с кэшем на время одной свечи)
+
+    Binance отдаёт не более 1000 свечей за запрос, поэтому история
+    подгружается постранично через since и собирается в один DataFrame.
+    """
+    cache_key = (symbol, timeframe)
+    cached = _ohlcv_cache.get(cache_key)
+    if cached is not None and time.time() - cached[0] < exchange.parse_timeframe(timeframe):
+        return cached[1].copy()
+
     try:
-        ohlcv = await exchange.fetch_ohlcv(symbol, timeframe=timeframe, limit=limit)
-        df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
-        return df
+        timeframe_ms = exchange.parse_timeframe(timeframe) * 1000
+        since = exchange.milliseconds() - limit * timeframe_ms
+        all_rows = []
+        while len(all_rows) < limit:
+            batch_limit = min(1000, limit - len(all_rows))
+            async with _fetch_semaphore:
+                batch = await exchange.fetch_ohlcv(symbol, timeframe=timeframe, since=since, limit=batch_limit)
+            if not batch:
+                break
+            all_rows.extend(batch)
+            since = batch[-1][0] + timeframe_ms
+            if len(batch) < batch_limit:
+                break
+
+        # Собираем DataFrame из типизированных массивов NumPy:
+        # float32 для цен и секундные метки — вдвое меньше байтов в памяти,
+        # точности float32 (~7 значащих цифр) для котировок достаточно
+        arr = np.asarray(all_rows, dtype=np.float64).reshape(-1, 6)
+        prices = arr[:, 1:6].astype(np.float32)
+        df = pd.DataFrame({
+            'timestamp': (arr[:, 0] // 1000).astype('int64').view('datetime64[s]'),
+            'open': prices[:, 0],
+            'high': prices[:, 1],
+            'low': prices[:, 2],
+            'close': prices[:, 3],
+            'volume': prices[:, 4],
+        }, copy=False)
+        _ohlcv_cache[cache_key] = (time.time(), df)
+        return df.copy()
     except Exception as e:
         print(f"Error fetching data for {symbol}: {e}")
         return None
 
-def get_price_changes(data):
-    """Определение изменений в цене и направления движения (рост/спад)"""
-    data['price_change'] = data['close'].pct_change()
-    data['direction'] = np.where(data['price_change'] > 0, 'рост', 'спад')
-    return data
+@app.on_event("startup")
+async def warm_up_exchange():
+    """Прогреваем список рынков при старте, а не на первом запросе"""
+    await load_markets_cached()
 
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    exchange = ccxt.binance()
+@app.on_event("shutdown")
+async def close_exchange():
+    """Закрываем соединение с биржей при остановке приложения"""
+    await exchange.close()
 
-    # Получаем данные по BTC/USDT
-    btc_data = await fetch_data(exchange, 'BTC/USDT')
+# Направления храним как int8-коды, строки подставляются только при рендере
+DIRECTION_LABELS = {1: 'рост', -1: 'спад'}
+
+# Общий каркас layout для /graph — собирается один раз вместо цепочки update_*.
+# template=None при сериализации подменяется обратно на тяжёлый шаблон
+# по умолчанию, поэтому явно ставим пустой шаблон 'none'
+GRAPH_LAYOUT = {
+    'xaxis': {'title': {'text': 'Время'}},
+    'yaxis': {'title': {'text': 'Цена BTC/USDT'}},
+    'yaxis2': {'overlaying': 'y', 'side': 'right'},
+    'height': 600,
+    'template': pio.templates['none'],
+}
+
+@njit(cache=True, nogil=True)
+def price_change_dir(close):
+    """Относительное изменение цены и код направления за один проход по массиву"""
+    n = close.shape[0]
+    pc = np.empty(n, np.float64)
+    dir_ = np.empty(n, np.int8)
+    if n > 0:
+        pc[0] = np.nan
+        dir_[0] = -1
+    for i in range(1, n):
+        d = close[i] - close[i - 1]
+        pc[i] = d / close[i - 1]
+        dir_[i] = 1 if d > 0 else -1
+    return pc, dir_
 
-    if btc_data is None:
-        return templates.TemplateResponse("index.html", {"request": request, "data": []})
+def get_price_changes(data):
+    """Определение изменений в цене и направления движения (1 — рост, -1 — спад)"""
+    pc, direction = price_change_dir(data['close'].to_numpy())
+    data['price_change'] = pc
+    data['direction'] = direction
+    return data
 
-    # Обработка данных биткоина
-    btc_data = get_price_changes(btc_data)
+@njit(cache=True, nogil=True)
+def process_kernel(alt_ts, alt_dir, btc_ts, btc_dir):
+    """Слитное ядро по одной паре: поиск последней метки биткоина,
+    фильтр совпадения направлений и агрегаты задержек за один проход.
+
+    Оба ряда меток отсортированы, поэтому указатель j по биткоину двигается
+    только вперёд. Коды направлений -1/1 отображаются в группы 0/1.
+    Возвращает построчные массивы совпавших строк и агрегаты по группам.
+    """
+    n = alt_ts.shape[0]
+    m = btc_ts.shape[0]
+    match_idx = np.empty(n, np.int64)
+    match_btc_ts = np.empty(n, np.int64)
+    match_delay = np.empty(n, np.float64)
+    delay_sum = np.zeros(2, np.float64)
+    count = np.zeros(2, np.int64)
+    first_btc = np.zeros(2, np.int64)
+    first_alt = np.zeros(2, np.int64)
+    k = 0
+    j = 0
+    for i in range(n):
+        while j + 1 < m and btc_ts[j + 1] <= alt_ts[i]:
+            j += 1
+        if m == 0 or btc_ts[j] > alt_ts[i]:
+            continue  # метка альткоина раньше первой метки биткоина
+        if alt_dir[i] != btc_dir[j]:
+            continue
+        g = 0 if btc_dir[j] < 0 else 1
+        if count[g] == 0:
+            first_btc[g] = btc_ts[j]
+            first_alt[g] = alt_ts[i]
+        delay = float(alt_ts[i] - btc_ts[j])
+        delay_sum[g] += delay
+        count[g] += 1
+        match_idx[k] = i
+        match_btc_ts[k] = btc_ts[j]
+        match_delay[k] = delay
+        k += 1
+    return match_idx[:k], match_btc_ts[:k], match_delay[:k], delay_sum, count, first_btc, first_alt
+
+def process_altcoin(symbol, altcoin_data, btc_ts, btc_dir):
+    """Обработка одной пары относительно биткоина (чистая CPU-функция)
+
+    btc_ts/btc_dir — общие read-only массивы NumPy (секунды от эпохи и
+    коды направлений); функция их не изменяет, поэтому её можно гонять
+    в пуле потоков.
+    """
+    try:
+        altcoin_data = get_price_changes(altcoin_data)
+
+        alt_ts = altcoin_data['timestamp'].to_numpy().astype('datetime64[s]').view('int64')
+        alt_dir = altcoin_data['direction'].to_numpy()
+        alt_close = altcoin_data['close'].to_numpy()
+
+        # Весь горячий путь — один проход скомпилированного ядра без pandas
+        match_idx, match_btc_ts, match_delay, delay_sum, count, first_btc, first_alt = \
+            process_kernel(alt_ts, alt_dir, btc_ts, btc_dir)
+
+        if len(match_idx):
+            # Итог по направлениям; направление альткоина внутри группы
+            # по построению фильтра совпадает с направлением биткоина
+            result = []
+            for g, code in enumerate((-1, 1)):
+                if count[g]:
+                    result.append({
+                        'direction_btc': DIRECTION_LABELS[code],
+                        'time_delay': float(delay_sum[g] / count[g]),
+                        'btc_time': np.datetime64(int(first_btc[g]), 's').item(),
+                        'altcoin_time': np.datetime64(int(first_alt[g]), 's').item(),
+                        'direction': DIRECTION_LABELS[code],
+                    })
+
+            matched_times = alt_ts[match_idx].astype('datetime64[s]').tolist()
+
+            # full_data отдаём колонками, а не словарём на каждую строку
+            return {
+                'altcoin_pair': symbol,
+                'result': result,
+                'full_data': {
+                    'timestamp': matched_times,
+                    'close': alt_close[match_idx].tolist(),
+                    'direction': [DIRECTION_LABELS[int(d)] for d in alt_dir[match_idx]],
+                    'btc_time': match_btc_ts.astype('datetime64[s]').tolist(),
+                    'altcoin_time': matched_times,
+                }
+            }
 
-    # Получаем список всех тикеров, оканчивающихся на /USDT
-    markets = await exchange.load_markets()
-    ticker_symbols = [symbol for symbol in markets.keys() if symbol != 'BTC/USDT' and symbol.endswith('/USDT')]
+    except Exception as e:
+        print(f"Error processing {symbol}: {e}")
 
-    # Асинхронно получаем данные по всем тикерам
-    tasks = [fetch_data(exchange, symbol) for symbol in ticker_symbols]
-    results = await asyncio.gather(*tasks)
+    return None
 
-    matching_results = []
+async def compute_matching_results():
+    """Анализ задержек альткоинов относительно биткоина по всем парам /USDT"""
+    # Получаем список всех тикеров, оканчивающихся на /USDT
+    ticker_symbols = await get_ticker_symbols()
 
-    for symbol, altcoin_data in zip(ticker_symbols, results):
-        if altcoin_data is None:
-            continue
+    # Асинхронно получаем данные по биткоину и всем тикерам одним пулом запросов
+    all_symbols = ['BTC/USDT'] + ticker_symbols
+    results = await asyncio.gather(*[fetch_data(exchange, symbol) for symbol in all_symbols])
 
-        try:
-            altcoin_data = get_price_changes(altcoin_data)
+    btc_data = results[0]
+    if btc_data is None:
+        return []
 
-            # Сводим данные по времени и направлению движения
-            merged_data = pd.merge_asof(altcoin_data, btc_data[['timestamp', 'direction', 'close']],
-                                        on='timestamp', suffixes=('', '_btc'))
+    # Обработка данных биткоина
+    btc_data = get_price_changes(btc_data)
 
-            # Отбираем строки, где направление альткоина совпадает с направлением биткоина
-            matching_data = merged_data[merged_data['direction'] == merged_data['direction_btc']]
+    # Общие массивы биткоина для ядра: секунды от эпохи и коды направлений
+    btc_ts = btc_data['timestamp'].to_numpy().astype('datetime64[s]').view('int64')
+    btc_dir = btc_data['direction'].to_numpy()
 
-            if not matching_data.empty:
-                # Находим задержку и добавляем время изменения
-                def calculate_time_delay_and_times(row, btc_data):
-                    btc_change_time = btc_data.loc[btc_data['timestamp'] <= row['timestamp'], 'timestamp'].max()
-                    delay = (row['timestamp'] - btc_change_time).total_seconds()
-                    return pd.Series({'time_delay': delay, 'btc_time': btc_change_time, 'altcoin_time': row['timestamp']})
+    # Пост-обработка каждой пары уходит в пул потоков: ядра собраны с
+    # nogil=True, поэтому пары считаются на ядрах параллельно
+    processed = await asyncio.gather(*[
+        asyncio.to_thread(process_altcoin, symbol, altcoin_data, btc_ts, btc_dir)
+        for symbol, altcoin_data in zip(all_symbols[1:], results[1:])
+        if altcoin_data is not None
+    ])
 
-                matching_data = matching_data.join(
-                    matching_data.apply(calculate_time_delay_and_times, axis=1, btc_data=btc_data)
-                )
+    return [r for r in processed if r is not None]
 
-                # Группируем данные по направлениям движения
-                result = matching_data.groupby(['direction_btc']).agg({
-                    'time_delay': 'mean',
-                    'btc_time': 'first',
-                    'altcoin_time': 'first',
-                    'direction': lambda x: x.mode()[0]
-                }).reset_index()
-
-                # Добавляем результат в список
-                matching_results.append({
-                    'altcoin_pair': symbol,
-                    'result': result.to_dict(orient='records'),
-                    'full_data': matching_data[['timestamp', 'close', 'direction', 'btc_time', 'altcoin_time']].to_dict(orient='records')
-                })
-
-        except Exception as e:
-            print(f"Error processing {symbol}: {e}")
-
-    # Закрываем соединение с биржей
-    await exchange.close()
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    matching_results = await compute_matching_results()
 
     # Рендерим HTML-шаблон с переданными данными
     return templates.TemplateResponse("index.html", {"request": request, "data": matching_results})
 
+@app.get("/data", response_class=ORJSONResponse)
+async def data():
+    """Те же результаты анализа, но как JSON-набор данных через orjson"""
+    return await compute_matching_results()
+
 @app.get("/graph", response_class=HTMLResponse)
 async def graph(request: Request):
-    exchange = ccxt.binance()
+    # Получаем список всех тикеров, оканчивающихся на /USDT
+    ticker_symbols = await get_ticker_symbols()
 
-    # Получаем данные по BTC/USDT
-    btc_data = await fetch_data(exchange, 'BTC/USDT')
+    # Асинхронно получаем данные по биткоину и всем тикерам одним пулом запросов
+    all_symbols = ['BTC/USDT'] + ticker_symbols
+    results = await asyncio.gather(*[fetch_data(exchange, symbol) for symbol in all_symbols])
 
+    btc_data = results[0]
     if btc_data is None:
         return JSONResponse(content={"error": "BTC/USDT data could not be fetched"})
 
-    # Обработка данных биткоина
-    btc_data = get_price_changes(btc_data)
-
     # Устанавливаем диапазон дат для последней недели
     end_date = btc_data['timestamp'].max()
     start_date = end_date - timedelta(days=7)
 
-    # Получаем список всех тикеров, оканчивающихся на /USDT
-    markets = await exchange.load_markets()
-    ticker_symbols = [symbol for symbol in markets.keys() if symbol != 'BTC/USDT' and symbol.endswith('/USDT')]
-
-    # Асинхронно получаем данные по всем тикерам
-    tasks = [fetch_data(exchange, symbol) for symbol in ticker_symbols]
-    results = await asyncio.gather(*tasks)
-
-    graphs = []
-    correlation_threshold = 0.8  # Порог корреляции для фильтрации
+    # Выравниваем цены закрытия всех альткоинов по сетке меток биткоина
+    btc_ts = btc_data['timestamp'].to_numpy()
+    btc_close = btc_data['close'].to_numpy()
 
-    for symbol, altcoin_data in zip(ticker_symbols, results):
-        if altcoin_data is None:
+    valid_symbols = []
+    valid_frames = []
+    aligned_list = []
+    for symbol, altcoin_data in zip(all_symbols[1:], results[1:]):
+        if altcoin_data is None or altcoin_data.empty:
             continue
+        alt_ts = altcoin_data['timestamp'].to_numpy()
+        alt_close = altcoin_data['close'].to_numpy()
+        if np.array_equal(alt_ts, btc_ts):
+            # Сетки меток совпадают (обычный случай при одинаковых timeframe/limit) —
+            # цены уже выровнены, поиск не нужен
+            aligned_list.append(alt_close)
+        else:
+            # Цена альткоина на момент каждой метки биткоина (последнее известное значение)
+            idx = np.searchsorted(alt_ts, btc_ts, side='right') - 1
+            aligned_list.append(alt_close[np.clip(idx, 0, len(alt_close) - 1)])
+        valid_symbols.append(symbol)
+        valid_frames.append(altcoin_data)
 
-        try:
-            altcoin_data = get_price_changes(altcoin_data)
-
-            # Приводим временные ряды биткоина и альткоина к одному временному интервалу
-            merged_data = pd.merge_asof(altcoin_data[['timestamp', 'close']], btc_data[['timestamp', 'close']], on='timestamp', suffixes=('', '_btc'))
-
-            # Вычисляем коэффициент корреляции
-            correlation = merged_data['close'].corr(merged_data['close_btc'])
-
-            if correlation >= correlation_threshold:
-                # Создаем графики для биткоина и альткоина, если они статистически похожи
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-
-                # График цены биткоина
-                fig.add_trace(
-                    go.Scatter(x=btc_data['timestamp'], y=btc_data['close'], mode='lines', name='BTC/USDT'),
-                    secondary_y=False,
-                )
-
-                # График цены альткоина
-                fig.add_trace(
-                    go.Scatter(x=altcoin_data['timestamp'], y=altcoin_data['close'], mode='lines', name=symbol),
-                    secondary_y=True,
-                )
-
-                # Настройка осей с фиксированным диапазоном для последней недели
-                fig.update_xaxes(title_text="Время", range=[start_date, end_date])
-                fig.update_yaxes(title_text="Цена BTC/USDT", secondary_y=False)
-                fig.update_yaxes(title_text=f"Цена {symbol}", secondary_y=True)
+    correlation_threshold = 0.8  # Порог корреляции для фильтрации
 
-                # Настройка заголовка
-                fig.update_layout(
-                    title_text=f"Сравнение цен BTC/USDT и {symbol} (Корреляция: {correlation:.2f})",
-                    height=600,
+    if aligned_list:
+        # Все корреляции одной матричной операцией вместо сотен вызовов corr
+        closes = np.stack(aligned_list, axis=1)
+        closes_c = closes - closes.mean(axis=0)
+        btc_c = btc_close - btc_close.mean()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corrs = (closes_c.T @ btc_c) / (np.linalg.norm(closes_c, axis=0) * np.linalg.norm(btc_c))
+        selected = np.flatnonzero(corrs >= correlation_threshold)
+    else:
+        selected = []
+
+    def render_graphs():
+        """Генерация страницы по частям — в памяти держится одна фигура за раз"""
+        yield templates.get_template("graph_head.html").render()
+
+        for graph_id, i in enumerate(selected, start=1):
+            symbol = valid_symbols[i]
+            altcoin_data = valid_frames[i]
+            correlation = corrs[i]
+
+            try:
+                # Создаем графики для биткоина и альткоина, если они статистически похожи.
+                # Фигура собирается из готовых словарей по общему каркасу layout
+                fig = go.Figure(
+                    data=[
+                        {'type': 'scatter', 'mode': 'lines', 'name': 'BTC/USDT',
+                         'x': btc_data['timestamp'], 'y': btc_data['close'], 'yaxis': 'y'},
+                        {'type': 'scatter', 'mode': 'lines', 'name': symbol,
+                         'x': altcoin_data['timestamp'], 'y': altcoin_data['close'], 'yaxis': 'y2'},
+                    ],
+                    layout={
+                        **GRAPH_LAYOUT,
+                        'xaxis': {**GRAPH_LAYOUT['xaxis'], 'range': [start_date, end_date]},
+                        'yaxis2': {**GRAPH_LAYOUT['yaxis2'], 'title': {'text': f"Цена {symbol}"}},
+                        'title': {'text': f"Сравнение цен BTC/USDT и {symbol} (Корреляция: {correlation:.2f})"},
+                    },
+                    skip_invalid=True,
                 )
 
-                graph_html = fig.to_html(full_html=False)
-                graphs.append({"symbol": symbol, "graph": graph_html})
+                # Передаём только JSON данных — HTML собирает клиент через Plotly.newPlot
+                graph_json = pio.to_json(fig, validate=False)
+            except Exception as e:
+                print(f"Error processing {symbol}: {e}")
+                continue
 
-        except Exception as e:
-            print(f"Error processing {symbol}: {e}")
+            yield templates.get_template("graph_item.html").render(
+                symbol=symbol, graph_id=graph_id, graph=graph_json)
 
-    # Закрываем соединение с биржей
-    await exchange.close()
+        yield templates.get_template("graph_tail.html").render()
 
-    return templates.TemplateResponse("graph.html", {"request": request, "graphs": graphs})
+    return StreamingResponse(render_graphs(), media_type="text/html")
 
 if __name__ == '__main__':
     import uvicorn